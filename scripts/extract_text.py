@@ -5,48 +5,69 @@ Usage: python scripts/extract_text.py --input data/textbooks/book.pdf --output d
 """
 
 import argparse
-import json
+import math
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import orjson
 from pypdf import PdfReader
 from transformers import AutoTokenizer
 from tqdm import tqdm
 
-def extract_text_from_pdf(pdf_path):
-    """Extract text from PDF file."""
+# Below this many pages per worker, process start-up outweighs the parallel speedup
+MIN_PAGES_PER_WORKER = 8
+
+def _extract_page_range(pdf_path, start, stop):
+    """Extract text from pages [start, stop) of a PDF (runs in a worker process)."""
+    # pypdf objects aren't picklable, so each worker opens its own reader
+    reader = PdfReader(pdf_path)
+    return [reader.pages[i].extract_text() for i in range(start, stop)]
+
+def extract_text_from_pdf(pdf_path, workers=None):
+    """Extract text from PDF file, splitting pages across worker processes."""
     reader = PdfReader(pdf_path)
-    text = ""
-    for page in reader.pages:
-        text += page.extract_text() + "\n"
-    return text
+    num_pages = len(reader.pages)
+    workers = min(workers or os.cpu_count() or 1, num_pages // MIN_PAGES_PER_WORKER)
+    
+    if workers <= 1:
+        pages = [page.extract_text() for page in reader.pages]
+    else:
+        # One contiguous page range per worker so each reopens the PDF only once
+        step = math.ceil(num_pages / workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_extract_page_range, str(pdf_path), start, min(start + step, num_pages))
+                for start in range(0, num_pages, step)
+            ]
+            pages = [text for future in futures for text in future.result()]
+    
+    return "".join(f"{page}\n" for page in pages)
 
 def chunk_text(text, tokenizer, max_tokens=512, overlap=50):
     """Chunk text into ~max_tokens pieces with overlap."""
+    if not 0 <= overlap < max_tokens:
+        raise ValueError(f"overlap must be in [0, max_tokens), got overlap={overlap}, max_tokens={max_tokens}")
+    
     # Tokenize the entire text
     tokens = tokenizer.encode(text, add_special_tokens=False)
     
-    chunks = []
-    chunk_id = 0
-    i = 0
+    # Each chunk starts max_tokens - overlap after the previous one
+    starts = range(0, len(tokens), max_tokens - overlap)
+    slices = [tokens[start:start + max_tokens] for start in starts]
+    
+    # Decode all chunks in one call (runs in Rust for fast tokenizers)
+    texts = tokenizer.batch_decode(slices, skip_special_tokens=True)
     
-    while i < len(tokens):
-        # Take up to max_tokens tokens
-        chunk_tokens = tokens[i:i + max_tokens]
-        chunk_text = tokenizer.decode(chunk_tokens, skip_special_tokens=True)
-        
-        chunks.append({
+    return [
+        {
             "chunk_id": chunk_id,
             "text": chunk_text,
             "token_count": len(chunk_tokens),
-            "start_token": i,
-            "end_token": i + len(chunk_tokens)
-        })
-        
-        chunk_id += 1
-        # Move forward with overlap
-        i += max_tokens - overlap
-    
-    return chunks
+            "start_token": start,
+            "end_token": start + len(chunk_tokens)
+        }
+        for chunk_id, (start, chunk_tokens, chunk_text) in enumerate(zip(starts, slices, texts))
+    ]
 
 def save_chunks(chunks, output_dir, source_file):
     """Save chunks as JSONL file."""
@@ -57,11 +78,12 @@ def save_chunks(chunks, output_dir, source_file):
     source_name = Path(source_file).stem
     output_file = output_dir / f"{source_name}_chunks.jsonl"
     
-    with open(output_file, 'w', encoding='utf-8') as f:
+    # orjson emits UTF-8 bytes directly; a large buffer batches the small writes
+    with open(output_file, 'wb', buffering=1 << 20) as f:
         for chunk in chunks:
             chunk["source_file"] = source_file
-            json.dump(chunk, f, ensure_ascii=False)
-            f.write('\n')
+            f.write(orjson.dumps(chunk))
+            f.write(b'\n')
     
     print(f"Saved {len(chunks)} chunks to {output_file}")
     return str(output_file)
@@ -73,12 +95,15 @@ def main():
     parser.add_argument("--max-tokens", type=int, default=512, help="Max tokens per chunk")
     parser.add_argument("--overlap", type=int, default=50, help="Token overlap between chunks")
     parser.add_argument("--tokenizer", default="gpt2", help="Tokenizer model name")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for PDF page extraction (default: CPU count)")
     
     args = parser.parse_args()
     
     # Load tokenizer
     print(f"Loading tokenizer: {args.tokenizer}")
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=True)
+    if not tokenizer.is_fast:
+        print(f"Warning: no fast tokenizer available for {args.tokenizer}; chunking will be slower")
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
     
@@ -102,7 +127,7 @@ def main():
     all_chunks = []
     for pdf_file in tqdm(pdf_files, desc="Processing PDFs"):
         print(f"\nProcessing: {pdf_file.name}")
-        text = extract_text_from_pdf(pdf_file)
+        text = extract_text_from_pdf(pdf_file, args.workers)
         chunks = chunk_text(text, tokenizer, args.max_tokens, args.overlap)
         save_chunks(chunks, args.output, str(pdf_file))
         all_chunks.extend(chunks)
@@ -2,38 +2,57 @@
 """
 Flask API server for RAG queries - can be called from Node.js backend.
 Usage: python scripts/rag_api_server.py --port 5000
+Production: WEB_CONCURRENCY=2 RAG_EAGER_INIT=1 gunicorn -k gthread --threads 16 --timeout 120 --pythonpath scripts -b 127.0.0.1:5000 rag_api_server:app
 """
 
 import os
 import sys
 import json
 import argparse
+import threading
 from pathlib import Path
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 
+load_dotenv()
+
+# Size thread pools before torch/faiss are imported: OpenMP and MKL read these
+# at load time, and rag_inference pins torch/FAISS to RAG_NUM_THREADS on import.
+# Workers under gunicorn (WEB_CONCURRENCY) split the cores.
+_workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+os.environ.setdefault("RAG_NUM_THREADS", str(max(1, min(4, (os.cpu_count() or 1) // _workers))))
+os.environ.setdefault("OMP_NUM_THREADS", os.environ["RAG_NUM_THREADS"])
+os.environ.setdefault("MKL_NUM_THREADS", os.environ["RAG_NUM_THREADS"])
+
 # Add scripts directory to path for imports
 sys.path.insert(0, str(Path(__file__).parent))
 from rag_inference import RAGService
 
-load_dotenv()
-
 app = Flask(__name__)
 CORS(app)  # Allow CORS for Node.js backend
 
 # Initialize RAG service (singleton)
 rag_service = None
+# Concurrent first requests under a threaded server must not each load the index
+_rag_service_lock = threading.Lock()
 
 def get_rag_service():
     """Get or initialize RAG service."""
     global rag_service
     if rag_service is None:
-        chunks_dir = os.getenv("CHUNKS_DIR", "data/processed_chunks")
-        index_dir = os.getenv("FAISS_INDEX_DIR", "data/faiss_index")
-        rag_service = RAGService(chunks_dir, index_dir)
-        rag_service.build_or_load_index()
-        rag_service.initialize_llm()
+        with _rag_service_lock:
+            if rag_service is None:
+                chunks_dir = os.getenv("CHUNKS_DIR", "data/processed_chunks")
+                index_dir = os.getenv("FAISS_INDEX_DIR", "data/faiss_index")
+                service = RAGService(chunks_dir, index_dir)
+                service.build_or_load_index()
+                service.initialize_llm()
+                service.warmup()
+                rag_service = service
+    # Under several gunicorn workers a rebuild only happens in one of them;
+    # the others pick up the new index files here
+    rag_service.reload_if_index_changed()
     return rag_service
 
 @app.route("/health", methods=["GET"])
@@ -41,6 +60,22 @@ def health():
     """Health check endpoint."""
     return jsonify({"status": "healthy"})
 
+def _stream_suggestion(rag, query, chat_history, scratchpad, k):
+    """Stream a nudge as Server-Sent Events: token frames, a references frame, then [DONE]."""
+    def events():
+        try:
+            for event in rag.stream_suggestion(query, chat_history, scratchpad, k):
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield "data: [DONE]\n\n"
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.route("/api/rag/suggest", methods=["POST"])
 def rag_suggest():
     """Generate gentle nudge prompt using RAG."""
@@ -55,6 +90,10 @@ def rag_suggest():
             return jsonify({"error": "query is required"}), 400
         
         rag = get_rag_service()
+        
+        if request.args.get("stream") in ("1", "true"):
+            return _stream_suggestion(rag, query, chat_history, scratchpad, k)
+        
         result = rag.generate_suggestion(
             query=query,
             chat_history=chat_history,
@@ -71,22 +110,77 @@ def rag_suggest():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/rag/suggest_batch", methods=["POST"])
+def rag_suggest_batch():
+    """Generate nudge prompts for several queries in one request."""
+    try:
+        data = request.json
+        queries = data.get("queries")
+        chat_histories = data.get("chat_histories")
+        scratchpads = data.get("scratchpads")
+        k = data.get("k", 3)
+        
+        if not queries or not isinstance(queries, list):
+            return jsonify({"error": "queries must be a non-empty list"}), 400
+        for name, values in (("chat_histories", chat_histories), ("scratchpads", scratchpads)):
+            if values is not None and (not isinstance(values, list) or len(values) != len(queries)):
+                return jsonify({"error": f"{name} must be a list the same length as queries"}), 400
+        
+        rag = get_rag_service()
+        results = rag.generate_suggestions_batch(
+            queries=queries,
+            chat_histories=chat_histories,
+            scratchpads=scratchpads,
+            k=k
+        )
+        
+        return jsonify({
+            "results": [
+                {
+                    "suggestion": result["suggestion"],
+                    "nudge": result.get("nudge", result["suggestion"]),
+                    "references": result["references"]
+                }
+                for result in results
+            ]
+        })
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/rag/cache/stats", methods=["GET"])
+def cache_stats():
+    """Report response and retrieval cache sizes and hit rates."""
+    try:
+        rag = get_rag_service()
+        return jsonify({
+            "responses": rag.response_cache.stats(),
+            "retrievals": rag.retrieval_cache.stats()
+        })
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/api/rag/rebuild-index", methods=["POST"])
 def rebuild_index():
     """Rebuild FAISS index from chunks."""
     try:
-        global rag_service
-        chunks_dir = os.getenv("CHUNKS_DIR", "data/processed_chunks")
-        index_dir = os.getenv("FAISS_INDEX_DIR", "data/faiss_index")
-        rag_service = RAGService(chunks_dir, index_dir)
-        rag_service.build_or_load_index(force_rebuild=True)
-        rag_service.initialize_llm()
+        # Reuse the running service so the embeddings model and LLM client
+        # are not re-initialized on every rebuild
+        rag = get_rag_service()
+        rag.build_or_load_index(force_rebuild=True)  # Also clears cached responses
         
         return jsonify({"status": "Index rebuilt successfully"})
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# gunicorn workers import this module without running __main__; with
+# RAG_EAGER_INIT=1 each worker loads the index, models and LLM client (and
+# warms them up) at boot instead of on its first request
+if os.getenv("RAG_EAGER_INIT") == "1":
+    get_rag_service()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="RAG API Server")
     parser.add_argument("--port", type=int, default=5000, help="Port to run server on")
@@ -94,6 +188,9 @@ if __name__ == "__main__":
     
     args = parser.parse_args()
     
+    # Load and warm up before accepting requests so the first one isn't a cold start
+    get_rag_service()
+    
     print(f"Starting RAG API server on http://{args.host}:{args.port}")
     app.run(host=args.host, port=args.port, debug=False)
 
@@ -5,49 +5,394 @@ Usage: python scripts/rag_inference.py --query "user question" --chat_history ".
 """
 
 import os
+import re
 import json
+import math
+import time
+import pickle
+import hashlib
 import argparse
+import functools
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import faiss
+import httpx
+import numpy as np
+import orjson
+import torch
 from dotenv import load_dotenv
 from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_openai import AzureChatOpenAI
 from langchain_core.documents import Document
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import HumanMessage, SystemMessage
 
 load_dotenv()
 
+def configure_threads(num_threads):
+    """Pin the torch and FAISS thread pools so embedding and search don't oversubscribe cores."""
+    faiss.omp_set_num_threads(num_threads)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(min(2, num_threads))
+    except RuntimeError:
+        pass  # Only settable once, before any inter-op work has run
+
+# Only pin when asked (rag_api_server.py sets it per worker); scripts and
+# offline index builds keep the libraries' all-cores defaults
+if os.getenv("RAG_NUM_THREADS"):
+    configure_threads(int(os.environ["RAG_NUM_THREADS"]))
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Below this many chunks an exact inner-product scan is already sub-millisecond
+FLAT_MAX_VECTORS = 4096
+
+# HNSW graph parameters (cosine similarity via inner product on normalized vectors)
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# Corpora at least this large use a compressed IVF-PQ index instead of HNSW;
+# training 8-bit PQ codebooks needs roughly 39 vectors per code
+IVFPQ_MIN_VECTORS = 39 * 256
+IVFPQ_SUBQUANTIZERS = 48  # Must divide the embedding dimension (384)
+IVFPQ_BITS = 8
+IVFPQ_NPROBE = 8
+
+# Batch size for encoding chunks at index build time
+INDEX_ENCODE_BATCH_SIZE = 128
+
+# Times to re-read the saved index if a concurrent rebuild replaces it mid-load
+INDEX_LOAD_ATTEMPTS = 3
+
+# Static instructions sent ahead of every request. Keeping them identical and
+# first lets Azure's automatic prompt caching reuse the shared prefix.
+NUDGE_INSTRUCTIONS = """You are a software design mentor providing gentle, thought-provoking nudges to guide designers in their thinking process.
+
+These nudges should be:
+- Short, gentle questions or prompts (1-2 sentences max)
+- Thought-provoking rather than prescriptive
+- Encouraging reflection on the problem, solution, or design process
+
+IMPORTANT: Generate ONLY a short nudge question or prompt (1-2 sentences). Do not provide full design suggestions or detailed explanations. Just the gentle nudge itself."""
+
+# Retrieved chunks are trimmed to their most query-relevant sentences before
+# going into the prompt; prefill cost grows with every context token
+CONTEXT_TOKENS_PER_DOC = 200
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+OVERLAP_PLACEHOLDER = "(overlaps an earlier reference)"
+
+# Per-chunk sentence embeddings used for condensing, keyed by docstore id,
+# so only the query is embedded on a retrieval cache miss
+SENTENCE_CACHE_SIZE = 4096
+
+# Keep-alive connection pool shared by all LLM calls in the process
+LLM_MAX_KEEPALIVE_CONNECTIONS = 32
+
+# Threads used to read chunk JSONL files in parallel
+CHUNK_LOADER_THREADS = 8
+
+# Full-response cache for repeated /api/rag/suggest calls
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL_SECONDS = 300
+
+# Retrieved-chunk cache keyed on (query, k) only, so it still hits when just
+# the chat history or scratchpad changed. Entries live until the index changes.
+RETRIEVAL_CACHE_SIZE = 256
+
+EMBED_DTYPES = ("auto", "fp32", "fp16", "int8")
+
+def _resolve_embed_dtype(device):
+    """Map EMBED_DTYPE to the precision actually usable on device."""
+    dtype = os.getenv("EMBED_DTYPE", "auto").lower()
+    if dtype not in EMBED_DTYPES:
+        raise ValueError(f"Unsupported EMBED_DTYPE: {dtype} (expected {', '.join(EMBED_DTYPES)})")
+    
+    # Reduced precision roughly halves embed latency on the query hot path.
+    # auto picks fp16 on CUDA and fp32 on CPU; int8 on CPU is opt-in since
+    # saved indexes were built from fp32 chunk vectors.
+    if dtype == "auto":
+        return "fp16" if device == "cuda" else "fp32"
+    if dtype == "fp16" and device != "cuda":
+        print("Warning: EMBED_DTYPE=fp16 needs CUDA; using fp32 on CPU")
+        return "fp32"
+    if dtype == "int8" and device == "cuda":
+        # Dynamically quantized Linear layers only have CPU kernels
+        print("Warning: EMBED_DTYPE=int8 is CPU-only; using fp16 on CUDA")
+        return "fp16"
+    return dtype
+
+# Shared embeddings model; loading SentenceTransformer weights is the slowest
+# part of (re)building the index, so it is created once per process.
+_EMBEDDINGS_SINGLETON = None
+# Precision the shared model runs at, after resolving EMBED_DTYPE for the device
+_EMBEDDINGS_DTYPE = None
+
+def _get_embeddings():
+    """Return the process-wide HuggingFaceEmbeddings instance."""
+    global _EMBEDDINGS_SINGLETON, _EMBEDDINGS_DTYPE
+    if _EMBEDDINGS_SINGLETON is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        # Validate before paying for the model load
+        dtype = _resolve_embed_dtype(device)
+        embeddings = HuggingFaceEmbeddings(
+            model_name=EMBEDDING_MODEL,
+            model_kwargs={"device": device},
+            encode_kwargs={"normalize_embeddings": True, "batch_size": 64}
+        )
+        
+        model = _sentence_transformer(embeddings)
+        if dtype == "fp16":
+            model.half()
+        elif dtype == "int8":
+            torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        _EMBEDDINGS_DTYPE = dtype
+        _EMBEDDINGS_SINGLETON = embeddings
+    return _EMBEDDINGS_SINGLETON
+
+_HTTP_CLIENT = None
+
+def _get_http_client():
+    """Return the process-wide keep-alive HTTP client used for LLM calls."""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None:
+        _HTTP_CLIENT = httpx.Client(
+            limits=httpx.Limits(max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS),
+            timeout=httpx.Timeout(60.0, connect=10.0)
+        )
+    return _HTTP_CLIENT
+
+def _load_jsonl(path):
+    """Parse one chunks JSONL file into a list of dicts."""
+    with open(path, 'rb', buffering=1 << 20) as f:
+        return [orjson.loads(line) for line in f if line.strip()]
+
+_ROLE_LABELS = {"user": "User", "assistant": "Assistant"}
+
+def _format_messages(messages):
+    """Render chat messages as 'User: ...' / 'Assistant: ...' lines, skipping other roles."""
+    return "\n".join(
+        f"{_ROLE_LABELS[role]}: {msg.get('content', '')}"
+        for msg in messages
+        if (role := msg.get("role", "user")) in _ROLE_LABELS
+    )
+
+@functools.lru_cache(maxsize=256)
+def _format_chat_history_json(raw):
+    """Parse and format a JSON chat history string; cached since clients resend the same history."""
+    try:
+        return _format_messages(orjson.loads(raw))
+    except Exception:
+        # If parsing fails, treat as plain text
+        return raw
+
+def _approx_tokens(text):
+    """Rough token count (~4 characters per token for English text)."""
+    return max(1, len(text) // 4)
+
+def _sentence_transformer(embeddings):
+    """Return the SentenceTransformer model wrapped by HuggingFaceEmbeddings."""
+    # Newer langchain-huggingface releases keep the model in a private attribute
+    return getattr(embeddings, "_client", None) or embeddings.client
+
+def _configure_search(index):
+    """Apply query-time search parameters to a built or loaded FAISS index."""
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVFPQ_NPROBE
+
+def _build_index(vecs):
+    """Build an inner-product FAISS index sized to the corpus."""
+    num_vectors, dim = vecs.shape
+    if num_vectors >= IVFPQ_MIN_VECTORS and dim % IVFPQ_SUBQUANTIZERS == 0:
+        # Large corpus: product-quantized IVF keeps the index small and memory-light
+        nlist = int(math.sqrt(num_vectors))
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(
+            quantizer, dim, nlist, IVFPQ_SUBQUANTIZERS, IVFPQ_BITS, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(vecs)
+    elif num_vectors <= FLAT_MAX_VECTORS:
+        index = faiss.IndexFlatIP(dim)
+    else:
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    
+    index.add(vecs)
+    _configure_search(index)
+    return index
+
+class QueryCache:
+    """Thread-safe LRU cache with optional TTL expiry and hit/miss stats."""
+    
+    def __init__(self, max_size=512, ttl_seconds=300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        """Return the cached value for key, or None on a miss or expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+    
+    def set(self, key, value):
+        """Store value under key, evicting the least recently used entry if full."""
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        """Drop all entries (stats are kept)."""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        """Return cache size and hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
 class RAGService:
     def __init__(self, chunks_dir="data/processed_chunks", index_dir="data/faiss_index"):
         self.chunks_dir = Path(chunks_dir)
         self.index_dir = Path(index_dir)
+        self.embeddings = None
+        self.embed_dtype = None
         self.vectorstore = None
         self.llm = None
+        self.response_cache = QueryCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS)
+        self.retrieval_cache = QueryCache(RETRIEVAL_CACHE_SIZE, ttl_seconds=None)
+        self.sentence_cache = QueryCache(SENTENCE_CACHE_SIZE, ttl_seconds=None)
+        # mtime of the index.faiss this process is serving, to notice rebuilds by other workers
+        self.index_mtime = None
+        self._reload_lock = threading.Lock()
         
+    def clear_caches(self):
+        """Invalidate cached responses and retrievals after the index changes."""
+        self.response_cache.clear()
+        self.retrieval_cache.clear()
+        self.sentence_cache.clear()  # Docstore ids refer to different chunks after a rebuild
+    
+    def load_embeddings(self):
+        """Load (or reuse) the shared embeddings model; the slowest part of startup."""
+        self.embeddings = _get_embeddings()
+        self.embed_dtype = _EMBEDDINGS_DTYPE
+        return self.embeddings
+    
     def load_chunks(self):
         """Load chunks from JSONL files."""
-        chunks = []
         if not self.chunks_dir.exists():
             print(f"Warning: {self.chunks_dir} does not exist. No chunks loaded.")
-            return chunks
-        
-        for jsonl_file in self.chunks_dir.glob("*.jsonl"):
-            with open(jsonl_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    if line.strip():
-                        chunk = json.loads(line)
-                        chunks.append(Document(
-                            page_content=chunk["text"],
-                            metadata={
-                                "chunk_id": chunk.get("chunk_id", 0),
-                                "source_file": chunk.get("source_file", ""),
-                                "token_count": chunk.get("token_count", 0)
-                            }
-                        ))
+            return []
+        
+        # Read and parse files concurrently; Documents are built afterwards in one pass
+        jsonl_files = sorted(self.chunks_dir.glob("*.jsonl"))
+        records = []
+        with ThreadPoolExecutor(max_workers=CHUNK_LOADER_THREADS) as executor:
+            for file_records in executor.map(_load_jsonl, jsonl_files):
+                records.extend(file_records)
+        
+        chunks = [
+            Document(
+                page_content=chunk["text"],
+                metadata={
+                    "chunk_id": chunk.get("chunk_id", 0),
+                    "source_file": chunk.get("source_file", ""),
+                    "token_count": chunk.get("token_count", 0)
+                }
+            )
+            for chunk in records
+        ]
         
         print(f"Loaded {len(chunks)} chunks")
         return chunks
     
+    def _saved_index_mtime(self):
+        """Return the saved index.faiss mtime in ns, or None if there is no saved index."""
+        try:
+            return (self.index_dir / "index.faiss").stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+    
+    def load_index_mmap(self):
+        """Load the saved FAISS index memory-mapped, without rebuilding; raises if it can't be used."""
+        self.load_embeddings()
+        
+        for _ in range(INDEX_LOAD_ATTEMPTS):
+            index_mtime = self._saved_index_mtime()
+            # Memory-map the index instead of FAISS.load_local reading it all into RAM;
+            # pages are faulted in on first access
+            index = faiss.read_index(
+                str(self.index_dir / "index.faiss"), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+            )
+            if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+                # Older indexes were L2 over unnormalized vectors
+                raise ValueError("index uses L2 distance, expected inner product")
+            # index.pkl is the (docstore, index_to_docstore_id) pair written by save_local
+            with open(self.index_dir / "index.pkl", 'rb') as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+            
+            # A rebuild landing between the two reads would pair the old index
+            # with the new docstore; read both again if index.faiss changed
+            if self._saved_index_mtime() == index_mtime and index.ntotal == len(index_to_docstore_id):
+                break
+        else:
+            raise ValueError("index.faiss and index.pkl do not match")
+        
+        self.vectorstore = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
+        _configure_search(self.vectorstore.index)
+        self.index_mtime = index_mtime
+        self.clear_caches()
+    
+    def reload_if_index_changed(self):
+        """Reload the saved index if another process has rebuilt it since this one loaded it."""
+        if self._saved_index_mtime() in (None, self.index_mtime):
+            return False
+        with self._reload_lock:
+            # Another thread may have reloaded while this one waited
+            if self._saved_index_mtime() in (None, self.index_mtime):
+                return False
+            self.load_index_mmap()
+        print(f"Reloaded FAISS index from {self.index_dir} after an external rebuild")
+        return True
+    
     def build_or_load_index(self, force_rebuild=False):
         """Build FAISS index from chunks or load existing."""
         # Check for existing index files (FAISS saves both index.faiss and index.pkl)
@@ -62,17 +407,8 @@ class RAGService:
             print(f"  Found: {index_faiss.name} ({index_faiss.stat().st_size} bytes)")
             print(f"  Found: {index_pkl.name} ({index_pkl.stat().st_size} bytes)")
             
-            embeddings = HuggingFaceEmbeddings(
-                model_name="sentence-transformers/all-MiniLM-L6-v2"
-            )
-            
             try:
-                # FAISS.load_local needs the directory path, not the file path
-                self.vectorstore = FAISS.load_local(
-                    str(self.index_dir), 
-                    embeddings,
-                    allow_dangerous_deserialization=True  # Required for loading pickled data
-                )
+                self.load_index_mmap()
                 print("✅ Index loaded successfully")
                 return True
             except Exception as e:
@@ -89,17 +425,46 @@ class RAGService:
             print("No chunks found. Please run extract_text.py first.")
             return False
         
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"
-        )
-        self.vectorstore = FAISS.from_documents(chunks, embeddings)
+        self.load_embeddings()
+        self.vectorstore = self._build_vectorstore(chunks)
+        self.clear_caches()
         
         self.index_dir.mkdir(parents=True, exist_ok=True)
-        self.vectorstore.save_local(str(self.index_dir))
+        # Save to a scratch directory and swap the files in, so an index that is
+        # still memory-mapped elsewhere is never truncated underneath its readers.
+        # index.faiss goes last: its mtime is what other workers watch to reload.
+        with tempfile.TemporaryDirectory(dir=self.index_dir) as tmp_dir:
+            self.vectorstore.save_local(tmp_dir)
+            for target in (index_pkl, index_faiss):
+                os.replace(Path(tmp_dir) / target.name, target)
+        self.index_mtime = self._saved_index_mtime()
         print(f"✅ Index saved to {self.index_dir}")
         
         return True
     
+    def _build_vectorstore(self, chunks):
+        """Embed chunks into an inner-product FAISS index wrapped as a LangChain FAISS store."""
+        # Encode with the underlying SentenceTransformer directly so large
+        # batches keep the device busy instead of LangChain's small defaults
+        vecs = _sentence_transformer(self.embeddings).encode(
+            [doc.page_content for doc in chunks],
+            batch_size=INDEX_ENCODE_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=True
+        ).astype("float32", copy=False)
+        faiss.normalize_L2(vecs)  # No-op safety: inner product must equal cosine
+        index = _build_index(vecs)
+        
+        ids = [str(i) for i in range(len(chunks))]
+        return FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore(dict(zip(ids, chunks))),
+            index_to_docstore_id=dict(enumerate(ids)),
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
+    
     def initialize_llm(self):
         """Initialize Azure OpenAI LLM (ZotGPT)."""
         api_key = os.getenv("API_KEY")
@@ -116,97 +481,122 @@ class RAGService:
             openai_api_version=api_version,
             openai_api_key=api_key,
             temperature=1.0,
-            max_tokens=150  # Reduced for short nudge prompts (1-2 sentences)
+            max_tokens=150,  # Reduced for short nudge prompts (1-2 sentences)
+            http_client=_get_http_client()  # Reuse TCP/TLS connections across calls
         )
         print("ZotGPT LLM initialized")
     
+    def warmup(self):
+        """Run a throwaway search and LLM call so the first real request skips cold-start costs."""
+        try:
+            # Initializes torch kernels, FAISS's OpenMP pool and the LLM TLS connection
+            self.vectorstore.similarity_search("warmup", k=1)
+            self.llm.invoke([HumanMessage(content="ping")])
+            print("Warmup complete")
+        except Exception as e:
+            print(f"Warning: warmup failed: {e}")
+    
     def format_chat_history(self, chat_history):
         """Format chat history string into messages."""
         if not chat_history:
             return []
         
+        # If it's a JSON string, parse it (memoized per distinct string)
+        if isinstance(chat_history, str):
+            return _format_chat_history_json(chat_history)
+        
         try:
-            # If it's a JSON string, parse it
-            if isinstance(chat_history, str):
-                messages = json.loads(chat_history)
-            else:
-                messages = chat_history
-            
-            # Convert to format expected by prompt
-            formatted = []
-            for msg in messages:
-                role = msg.get("role", "user")
-                content = msg.get("content", "")
-                if role == "user":
-                    formatted.append(f"User: {content}")
-                elif role == "assistant":
-                    formatted.append(f"Assistant: {content}")
-            
-            return "\n".join(formatted)
-        except:
-            # If parsing fails, treat as plain text
+            return _format_messages(chat_history)
+        except Exception:
             return chat_history
     
-    def generate_suggestion(self, query, chat_history=None, scratchpad=None, k=3):
-        """Generate design suggestion using RAG."""
-        if not self.vectorstore:
-            raise ValueError("Vector store not initialized. Call build_or_load_index() first.")
+    def _cache_key(self, query, chat_history, scratchpad, k):
+        """Digest of everything that determines a suggestion, for the response cache."""
+        return hashlib.blake2b(
+            json.dumps([query, k, chat_history, scratchpad], sort_keys=True, default=str).encode("utf-8")
+        ).digest()
+    
+    def _sentence_vectors(self, hits):
+        """Return (sentences, vectors) for each (docstore_id, doc) hit, embedding a chunk's sentences only once."""
+        entries = [self.sentence_cache.get(doc_id) for doc_id, _ in hits]
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if not missing:
+            return entries
         
-        if not self.llm:
-            self.initialize_llm()
+        split = []
+        for i in missing:
+            sentences = (" ".join(part.split()) for part in _SENTENCE_BOUNDARY.split(hits[i][1].page_content))
+            split.append([sentence for sentence in sentences if sentence])
+        all_sentences = [sentence for sentences in split for sentence in sentences]
+        # One embed call for every uncached chunk's sentences
+        vecs = np.asarray(self.embeddings.embed_documents(all_sentences), dtype="float32") if all_sentences else None
         
-        # Retrieve relevant chunks
-        # Use similarity_search directly for compatibility with all LangChain versions
-        relevant_docs = self.vectorstore.similarity_search(query, k=k)
+        offset = 0
+        for i, sentences in zip(missing, split):
+            entries[i] = (sentences, vecs[offset:offset + len(sentences)] if sentences else None)
+            offset += len(sentences)
+            self.sentence_cache.set(hits[i][0], entries[i])
+        return entries
+    
+    def _condense_context(self, query_vec, hits, max_tokens=CONTEXT_TOKENS_PER_DOC):
+        """Reduce each retrieved chunk to its most query-relevant sentences, dropping repeats across chunks.
         
-        # Build context from retrieved chunks
-        context_parts = []
-        for i, doc in enumerate(relevant_docs, 1):
-            context_parts.append(f"[Reference {i}]\n{doc.page_content}")
+        Returns exactly one passage per hit, so [Reference i] lines up with the returned references.
+        """
+        query_vec = np.asarray(query_vec, dtype="float32")
+        seen = set()
+        passages = []
+        for (_, doc), (sentences, vecs) in zip(hits, self._sentence_vectors(hits)):
+            keep = {}
+            if sentences:
+                # Embeddings are normalized, so the dot product is cosine similarity
+                budget = max_tokens
+                for j in np.argsort(-(vecs @ query_vec)):
+                    sentence = sentences[j]
+                    if sentence in seen:
+                        continue
+                    cost = _approx_tokens(sentence)
+                    if cost <= budget:
+                        keep[j] = sentence
+                        budget -= cost
+                    elif not keep:
+                        # Best sentence alone is over budget (tables, code, run-on PDF text): truncate it
+                        keep[j] = sentence[:budget * 4]
+                        break
+                seen.update(sentences[j] for j in keep)
+            
+            if keep:
+                passages.append(" ".join(keep[j] for j in sorted(keep)))
+            else:
+                # Every sentence already appeared in an earlier chunk; keep the
+                # [Reference i] numbering without spending prefill on repeats
+                passages.append(OVERLAP_PLACEHOLDER)
         
-        context = "\n\n".join(context_parts)
+        return passages
+    
+    def _build_messages(self, query, passages, chat_history=None, scratchpad=None):
+        """Build the nudge prompt messages: static instructions first, request-specific context last."""
+        # Build context from condensed chunks
+        context = "\n\n".join(
+            f"[Reference {i}]\n{passage}" for i, passage in enumerate(passages, 1)
+        )
         
         # Format chat history
         chat_context = self.format_chat_history(chat_history) if chat_history else ""
         
-        # Build prompt for generating gentle nudge prompts
-        prompt_template = """You are a software design mentor providing gentle, thought-provoking nudges to guide designers in their thinking process.
-
-These nudges should be:
-- Short, gentle questions or prompts (1-2 sentences max)
-- Thought-provoking rather than prescriptive
-- Encouraging reflection on the problem, solution, or design process
-
-
-IMPORTANT: Generate ONLY a short nudge question or prompt (1-2 sentences). Do not provide full design suggestions or detailed explanations. Just the gentle nudge itself.
-
-{context_section}
-
-{chat_section}
-
-{scratchpad_section}
-
-Based on the above context, chat history, and scratchpad notes, generate a single gentle nudge prompt (a reflective question or gentle suggestion) that would help the designer think more deeply about the following query:
-
-Query: {query}
-
-Nudge Prompt (just the question/prompt, 1-2 sentences max):"""
-        
-        context_section = f"Relevant Knowledge:\n{context}" if context else ""
-        chat_section = f"Chat History:\n{chat_context}" if chat_context else ""
-        scratchpad_section = f"Scratchpad Notes:\n{scratchpad}" if scratchpad else ""
-        
-        prompt = prompt_template.format(
-            context_section=context_section,
-            chat_section=chat_section,
-            scratchpad_section=scratchpad_section,
-            query=query
-        )
-        
-        # Generate response using HumanMessage format
-        response = self.llm.invoke([HumanMessage(content=prompt)]).content
-        
-        # Return response with references
+        sections = [
+            f"Relevant Knowledge:\n{context}" if context else "",
+            f"Chat History:\n{chat_context}" if chat_context else "",
+            f"Scratchpad Notes:\n{scratchpad}" if scratchpad else "",
+            "Based on the above, write one gentle nudge (a reflective question or suggestion, "
+            f"1-2 sentences) to help the designer think more deeply about this query:\nQuery: {query}",
+            "Nudge Prompt:"
+        ]
+        prompt = "\n\n".join(section for section in sections if section)
+        return [SystemMessage(content=NUDGE_INSTRUCTIONS), HumanMessage(content=prompt)]
+    
+    def _format_result(self, response, relevant_docs):
+        """Package an LLM response with references to the retrieved chunks."""
         references = [
             {
                 "chunk_id": doc.metadata.get("chunk_id", i),
@@ -221,6 +611,142 @@ Nudge Prompt (just the question/prompt, 1-2 sentences max):"""
             "nudge": response,  # Alias for consistency
             "references": references
         }
+    
+    def embed_query(self, query):
+        """Embed a single query as a normalized vector."""
+        return self.embeddings.embed_query(query)
+    
+    def embed_queries(self, queries):
+        """Embed several queries in one batch as normalized vectors."""
+        return self.embeddings.embed_documents(list(queries))
+    
+    def _search(self, q_vecs, k):
+        """Run one FAISS search for a matrix of query vectors; returns (docstore_id, Document) hits per query."""
+        q_vecs = np.asarray(q_vecs, dtype="float32")
+        faiss.normalize_L2(q_vecs)
+        # One snapshot, so a concurrent reload can't pair the old index with the new docstore
+        vectorstore = self.vectorstore
+        _, indices = vectorstore.index.search(q_vecs, k)
+        
+        docstore = vectorstore.docstore
+        id_map = vectorstore.index_to_docstore_id
+        return [
+            [(id_map[i], docstore.search(id_map[i])) for i in row if i != -1]
+            for row in indices
+        ]
+    
+    def _retrieval_key(self, query, k):
+        """Retrieval cache key; depends only on the query text and k."""
+        return hashlib.blake2b(f"{k}\0{query}".encode("utf-8")).digest()
+    
+    def _retrieve(self, query, k=3):
+        """Return the top-k chunks for query and their condensed passages, reusing earlier results."""
+        cache_key = self._retrieval_key(query, k)
+        cached = self.retrieval_cache.get(cache_key)
+        if cached is None:
+            query_vec = self.embed_query(query)
+            hits = self._search([query_vec], k)[0]
+            cached = ([doc for _, doc in hits], self._condense_context(query_vec, hits))
+            self.retrieval_cache.set(cache_key, cached)
+        return cached
+    
+    def batch_retrieve(self, queries, k=3):
+        """Retrieve (chunks, condensed passages) for several queries; misses share one embed call and FAISS search."""
+        if not self.vectorstore:
+            raise ValueError("Vector store not initialized. Call build_or_load_index() first.")
+        
+        cache_keys = [self._retrieval_key(query, k) for query in queries]
+        results = [self.retrieval_cache.get(cache_key) for cache_key in cache_keys]
+        missing = [i for i, cached in enumerate(results) if cached is None]
+        if missing:
+            q_vecs = self.embed_queries([queries[i] for i in missing])
+            for i, query_vec, hits in zip(missing, q_vecs, self._search(q_vecs, k)):
+                results[i] = ([doc for _, doc in hits], self._condense_context(query_vec, hits))
+                self.retrieval_cache.set(cache_keys[i], results[i])
+        return results
+    
+    def _prepare_request(self, query, chat_history, scratchpad, k):
+        """Check the index is loaded, create the LLM client if needed and look up the response cache.
+        
+        Returns (cache_key, cached_result); cached_result is None on a miss.
+        """
+        if not self.vectorstore:
+            raise ValueError("Vector store not initialized. Call build_or_load_index() first.")
+        
+        if not self.llm:
+            self.initialize_llm()
+        
+        cache_key = self._cache_key(query, chat_history, scratchpad, k)
+        return cache_key, self.response_cache.get(cache_key)
+    
+    def generate_suggestion(self, query, chat_history=None, scratchpad=None, k=3):
+        """Generate design suggestion using RAG."""
+        cache_key, cached = self._prepare_request(query, chat_history, scratchpad, k)
+        if cached is not None:
+            return cached
+        
+        # Retrieve relevant chunks
+        relevant_docs, passages = self._retrieve(query, k=k)
+        
+        messages = self._build_messages(query, passages, chat_history, scratchpad)
+        response = self.llm.invoke(messages).content
+        
+        result = self._format_result(response, relevant_docs)
+        self.response_cache.set(cache_key, result)
+        return result
+    
+    def stream_suggestion(self, query, chat_history=None, scratchpad=None, k=3):
+        """Yield {"token": ...} events as the LLM generates, then a final {"references": ...} event."""
+        cache_key, result = self._prepare_request(query, chat_history, scratchpad, k)
+        if result is not None:
+            yield {"token": result["suggestion"]}
+            yield {"references": result["references"]}
+            return
+        
+        relevant_docs, passages = self._retrieve(query, k=k)
+        messages = self._build_messages(query, passages, chat_history, scratchpad)
+        
+        tokens = []
+        for chunk in self.llm.stream(messages):
+            if chunk.content:
+                tokens.append(chunk.content)
+                yield {"token": chunk.content}
+        
+        result = self._format_result("".join(tokens), relevant_docs)
+        self.response_cache.set(cache_key, result)
+        yield {"references": result["references"]}
+    
+    def generate_suggestions_batch(self, queries, chat_histories=None, scratchpads=None, k=3):
+        """Generate suggestions for several queries, batching retrieval and LLM calls."""
+        chat_histories = chat_histories or [None] * len(queries)
+        scratchpads = scratchpads or [None] * len(queries)
+        if not len(queries) == len(chat_histories) == len(scratchpads):
+            raise ValueError("queries, chat_histories and scratchpads must have the same length")
+        
+        results = [None] * len(queries)
+        cache_keys = []
+        pending = []
+        for i, (query, chat_history, scratchpad) in enumerate(zip(queries, chat_histories, scratchpads)):
+            cache_key, results[i] = self._prepare_request(query, chat_history, scratchpad, k)
+            cache_keys.append(cache_key)
+            if results[i] is None:
+                pending.append(i)
+        
+        if not pending:
+            return results
+        
+        retrieved = self.batch_retrieve([queries[i] for i in pending], k)
+        prompts = [
+            self._build_messages(queries[i], passages, chat_histories[i], scratchpads[i])
+            for i, (_, passages) in zip(pending, retrieved)
+        ]
+        responses = self.llm.batch(prompts)
+        
+        for i, (docs, _), response in zip(pending, retrieved, responses):
+            results[i] = self._format_result(response.content, docs)
+            self.response_cache.set(cache_keys[i], results[i])
+        
+        return results
 
 def main():
     parser = argparse.ArgumentParser(description="Generate gentle nudge prompts using RAG with ZotGPT")
@@ -2,31 +2,258 @@
 """
 Test script for the RAG pipeline.
 Tests document processing, indexing, and API endpoints.
+Usage: python scripts/test_rag_pipeline.py [--server-mode]
 """
 
 import os
 import sys
-import json
+import argparse
+import subprocess
+import math
+import hashlib
+import functools
+import orjson
 import requests
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from pathlib import Path
+from urllib.parse import urlparse
+import numpy as np
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Add scripts directory to path
 sys.path.insert(0, str(Path(__file__).parent))
-from rag_inference import RAGService
 
 load_dotenv()
 
+@functools.lru_cache(maxsize=1)
+def rag_inference():
+    """Import rag_inference on first use; it pulls in torch, transformers and faiss."""
+    import rag_inference
+    return rag_inference
+
+SAMPLE_CHUNK_TEXT = "To implement caching in a web application, use Redis or Memcached for in-memory storage. Cache frequently accessed data like user profiles and session data. Set appropriate TTL (time-to-live) values to ensure data freshness. Consider cache invalidation strategies when data is updated."
+
+@dataclass(frozen=True)
+class Cfg:
+    """Test configuration, read from the environment once at import."""
+    chunks_dir: str
+    index_dir: str
+    api_url: str
+
+CFG = Cfg(
+    chunks_dir=os.getenv("CHUNKS_DIR", "data/processed_chunks"),
+    index_dir=os.getenv("FAISS_INDEX_DIR", "data/faiss_index"),
+    api_url=os.getenv("RAG_API_URL", "http://localhost:5000")
+)
+
+# Shared HTTP session: keeps connections to the API server alive across requests.
+# Transient gateway errors are retried with exponential backoff (0.2s, 0.4s, 0.8s);
+# POST is included since generating a suggestion has no side effects. Read
+# timeouts are not retried: the server may still be generating the first answer.
+RETRY = Retry(
+    total=3,
+    read=0,
+    backoff_factor=0.2,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=frozenset(["GET", "POST"])
+)
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=16, max_retries=RETRY))
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=16, max_retries=RETRY))
+SESSION.headers.update({"Content-Type": "application/json", "Connection": "keep-alive"})
+
+# Representative queries of varied length, sent together so retrieval and
+# LLM calls are exercised as a batch rather than one at a time
+TEST_QUERIES = [
+    {
+        "query": "How should I implement caching?",
+        "chat_history": [{"role": "user", "content": "My API is getting slow"}],
+        "scratchpad": "Need low latency, handle 10k concurrent users"
+    },
+    {
+        "query": "Should I split this into microservices?",
+        "chat_history": [],
+        "scratchpad": "Monolith, 3 developers"
+    },
+    {
+        "query": "How do I keep the order service and inventory service consistent when a payment fails halfway through checkout?",
+        "chat_history": [
+            {"role": "user", "content": "We have separate databases per service"},
+            {"role": "assistant", "content": "What happens today when one of the writes fails?"}
+        ],
+        "scratchpad": "Eventual consistency is acceptable; no distributed transactions"
+    },
+    {
+        "query": "What should I test first?",
+        "chat_history": [],
+        "scratchpad": ""
+    },
+    {
+        "query": "How can I make the design easier to change when requirements are still unclear?",
+        "chat_history": [{"role": "user", "content": "The client keeps changing the spec"}],
+        "scratchpad": "Prototype due in two weeks"
+    }
+]
+
+# Queries per batched call; batches are formed from length-sorted queries so
+# each one holds prompts of similar size and little padding
+BATCH_BUCKET_SIZE = 2
+
+def length_buckets(cases, bucket_size=BATCH_BUCKET_SIZE):
+    """Group test cases into batches of similar prompt length, returning lists of indices."""
+    lengths = [
+        len(case["query"].split())
+        + len(case["scratchpad"].split())
+        + sum(len(msg["content"].split()) for msg in case["chat_history"])
+        for case in cases
+    ]
+    order = np.argsort(lengths, kind="stable")
+    return [bucket.tolist() for bucket in np.array_split(order, math.ceil(len(order) / bucket_size))]
+
+# On-disk cache of query embeddings, so repeated suite runs skip re-encoding the same test queries
+EMBED_CACHE_DIR = Path("data/.embed_cache")
+EMBED_CACHE_MAX_ENTRIES = 1000
+
+def _embed_cache_path(query, dtype):
+    # Vectors differ slightly between precisions, so the dtype is part of the key
+    key = hashlib.sha256(
+        f"{rag_inference().EMBEDDING_MODEL}\0{dtype}\0{query}".encode("utf-8")
+    ).hexdigest()
+    return EMBED_CACHE_DIR / f"{key}.npy"
+
+def _prune_embed_cache():
+    """Drop least recently used entries beyond EMBED_CACHE_MAX_ENTRIES."""
+    entries = sorted(EMBED_CACHE_DIR.glob("*.npy"), key=lambda path: path.stat().st_mtime)
+    for path in entries[:max(0, len(entries) - EMBED_CACHE_MAX_ENTRIES)]:
+        path.unlink(missing_ok=True)
+
+def use_embedding_cache(rag):
+    """Route rag.embed_query / rag.embed_queries through the on-disk embedding cache."""
+    compute_batch = rag.embed_queries
+    
+    def embed_queries(queries):
+        queries = list(queries)
+        vecs = [None] * len(queries)
+        missing = []
+        for i, query in enumerate(queries):
+            path = _embed_cache_path(query, rag.embed_dtype)
+            if path.exists():
+                os.utime(path)  # Mark as recently used
+                vecs[i] = np.load(path).tolist()
+            else:
+                missing.append(i)
+        
+        if missing:
+            EMBED_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            for i, vec in zip(missing, compute_batch([queries[i] for i in missing])):
+                np.save(_embed_cache_path(queries[i], rag.embed_dtype), np.asarray(vec, dtype=np.float32))
+                vecs[i] = vec
+            _prune_embed_cache()
+        return vecs
+    
+    rag.embed_queries = embed_queries
+    rag.embed_query = lambda query: embed_queries([query])[0]
+
+# Per-phase latencies (ms), written to PERF_FILE at the end of the run for regression tracking
+PERF_FILE = Path("data/.perf.json")
+PERF = {}
+
+class PhaseTimer:
+    """Context manager that records a phase's wall-clock time in PERF and prints it."""
+    
+    def __init__(self, phase):
+        self.phase = phase
+        self.dt_ms = None
+    
+    def __enter__(self):
+        self.t = time.perf_counter_ns()
+        return self
+    
+    def __exit__(self, *exc):
+        self.dt_ms = (time.perf_counter_ns() - self.t) / 1e6
+        PERF[self.phase] = round(self.dt_ms, 3)
+        print(f"[{self.phase}] {self.dt_ms:.1f} ms")
+
+PAGE_SIZE = 4096
+
+# fp32 embedding of SAMPLE_CHUNK_TEXT, computed once so the precision check
+# doesn't load a second copy of the model on every run
+EMBED_REFERENCE_DIR = EMBED_CACHE_DIR / "fp32_reference"
+
+def _fp32_reference():
+    key = hashlib.sha256(f"{rag_inference().EMBEDDING_MODEL}\0{SAMPLE_CHUNK_TEXT}".encode("utf-8")).hexdigest()
+    path = EMBED_REFERENCE_DIR / f"{key}.npy"
+    if path.exists():
+        return np.load(path)
+    
+    from sentence_transformers import SentenceTransformer
+    reference = SentenceTransformer(rag_inference().EMBEDDING_MODEL, device="cpu").encode(
+        SAMPLE_CHUNK_TEXT, normalize_embeddings=True
+    ).astype(np.float32)
+    EMBED_REFERENCE_DIR.mkdir(parents=True, exist_ok=True)
+    np.save(path, reference)
+    return reference
+
+def check_embedding_precision(rag, min_cosine=0.99):
+    """Compare the service's reduced-precision embedding of the sample chunk against fp32."""
+    if rag.embed_dtype == "fp32":
+        print("✅ Embedding precision: fp32, nothing to compare")
+        return True
+    
+    # Bypass the on-disk cache: this must measure the live model
+    vec = np.asarray(rag.embeddings.embed_query(SAMPLE_CHUNK_TEXT), dtype=np.float32)
+    cosine = float(vec @ _fp32_reference() / np.linalg.norm(vec))
+    ok = cosine > min_cosine
+    print(f"{'✅' if ok else '❌'} Embedding precision ({rag.embed_dtype}) vs fp32: cosine={cosine:.4f}")
+    return ok
+
+def prefetch_index(rag):
+    """Pull the index file into the page cache in the background so mmap'd searches don't fault on disk.
+    
+    FAISS only memory-maps IVF inverted lists; flat and HNSW indexes are read
+    fully into RAM on load, so there is nothing to prefetch for them.
+    Returns the prefetch thread (join it before timing queries), or None.
+    """
+    if not isinstance(rag.vectorstore.index, rag_inference().faiss.IndexIVF):
+        return None
+    path = Path(rag.index_dir) / "index.faiss"
+    
+    def touch_pages():
+        with open(path, 'rb', buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+            # Read one byte per page to force residency
+            for offset in range(0, size, PAGE_SIZE):
+                f.seek(offset)
+                f.read(1)
+    
+    thread = threading.Thread(target=touch_pages, name="index-prefetch", daemon=True)
+    thread.start()
+    return thread
+
+# Steps may run on different threads; keep their section headers intact
+_PRINT_LOCK = threading.Lock()
+
+def print_header(title):
+    """Print a step section header."""
+    with _PRINT_LOCK:
+        print("\n" + "="*60)
+        print(title)
+        print("="*60)
+
 def test_document_processing():
     """Test Step 1: Document extraction and chunking."""
-    print("\n" + "="*60)
-    print("STEP 1: Testing Document Processing")
-    print("="*60)
+    print_header("STEP 1: Testing Document Processing")
     
     # Check if we have sample PDFs or need to create test data
     textbooks_dir = Path("data/textbooks")
-    chunks_dir = Path("data/processed_chunks")
+    chunks_dir = Path(CFG.chunks_dir)
     
     if not textbooks_dir.exists():
         print(f"⚠️  {textbooks_dir} directory doesn't exist.")
@@ -37,15 +264,13 @@ def test_document_processing():
         chunks_dir.mkdir(parents=True, exist_ok=True)
         sample_chunk = {
             "chunk_id": 0,
-            "text": "To implement caching in a web application, use Redis or Memcached for in-memory storage. Cache frequently accessed data like user profiles and session data. Set appropriate TTL (time-to-live) values to ensure data freshness. Consider cache invalidation strategies when data is updated.",
+            "text": SAMPLE_CHUNK_TEXT,
             "token_count": 45,
             "source_file": "sample_design_patterns.pdf"
         }
         
         sample_file = chunks_dir / "sample_chunks.jsonl"
-        with open(sample_file, 'w') as f:
-            json.dump(sample_chunk, f)
-            f.write('\n')
+        sample_file.write_bytes(orjson.dumps(sample_chunk) + b"\n")
         
         print(f"✅ Created sample chunk file: {sample_file}")
         return True
@@ -60,77 +285,98 @@ def test_document_processing():
         print(f"   Run: python scripts/extract_text.py --input {textbooks_dir} --output {chunks_dir}/")
         return True
 
-def test_rag_service():
+def test_rag_service(rag=None):
     """Test Step 2: RAG service initialization and indexing."""
-    print("\n" + "="*60)
-    print("STEP 2: Testing RAG Service")
-    print("="*60)
+    print_header("STEP 2: Testing RAG Service")
     
     try:
-        chunks_dir = os.getenv("CHUNKS_DIR", "data/processed_chunks")
-        index_dir = os.getenv("FAISS_INDEX_DIR", "data/faiss_index")
+        if rag is None:
+            rag = rag_inference().RAGService(CFG.chunks_dir, CFG.index_dir)
         
         print(f"Loading RAG service...")
-        print(f"  Chunks dir: {chunks_dir}")
-        print(f"  Index dir: {index_dir}")
-        
-        rag = RAGService(chunks_dir, index_dir)
+        print(f"  Chunks dir: {rag.chunks_dir}")
+        print(f"  Index dir: {rag.index_dir}")
         
         print("\nBuilding/loading FAISS index...")
-        success = rag.build_or_load_index()
+        with PhaseTimer("index"):
+            success = rag.build_or_load_index()
         if not success:
             print("❌ Failed to build index. Make sure you have processed documents first.")
             return False
         
         print("✅ Index built/loaded successfully")
+        # Overlaps with LLM init and warmup below
+        prefetch = prefetch_index(rag)
         
         print("\nInitializing ZotGPT LLM...")
-        rag.initialize_llm()
+        with PhaseTimer("llm_init"):
+            rag.initialize_llm()
         print("✅ LLM initialized")
         
+        # One throwaway end-to-end query so the measured queries don't pay for
+        # cold torch kernels, FAISS pages, the TLS handshake or an uncached prompt prefix
+        print("\nWarming up...")
+        with PhaseTimer("warmup") as timer:
+            rag.generate_suggestion(query="warmup", chat_history=[], scratchpad="", k=1)
+        print(f"✅ Warmup done (warmup_ms={timer.dt_ms:.0f})")
+        
+        if prefetch is not None:
+            prefetch.join()
+        
         return True
     except Exception as e:
         print(f"❌ Error: {e}")
         return False
 
-def test_rag_query():
+def test_rag_query(rag=None):
     """Test Step 3: Query the RAG service directly."""
-    print("\n" + "="*60)
-    print("STEP 3: Testing RAG Query (Direct)")
-    print("="*60)
+    print_header("STEP 3: Testing RAG Query (Direct)")
     
     try:
-        chunks_dir = os.getenv("CHUNKS_DIR", "data/processed_chunks")
-        index_dir = os.getenv("FAISS_INDEX_DIR", "data/faiss_index")
-        
-        rag = RAGService(chunks_dir, index_dir)
-        rag.build_or_load_index()
-        rag.initialize_llm()
-        
-        query = "How should I implement caching?"
-        chat_history = [{"role": "user", "content": "My API is getting slow"}]
-        scratchpad = "Need low latency, handle 10k concurrent users"
-        
-        print(f"Query: {query}")
-        print(f"Chat history: {len(chat_history)} messages")
-        print(f"Scratchpad: {scratchpad}")
-        print("\nGenerating suggestion...")
-        
-        result = rag.generate_suggestion(
-            query=query,
-            chat_history=chat_history,
-            scratchpad=scratchpad,
-            k=3
-        )
+        # Reuse an already-initialized service instead of reloading the model and index
+        if rag is None:
+            rag = rag_inference().RAGService(CFG.chunks_dir, CFG.index_dir)
+            rag.build_or_load_index()
+            rag.initialize_llm()
         
-        print("\n✅ Suggestion generated:")
-        print("-" * 60)
-        print(result["suggestion"])
-        print("-" * 60)
-        print(f"\n📚 References: {len(result['references'])} chunks retrieved")
-        for i, ref in enumerate(result["references"], 1):
-            print(f"  [{i}] Source: {ref['source']}")
-            print(f"      Preview: {ref['preview'][:100]}...")
+        if not check_embedding_precision(rag):
+            return False
+        
+        queries = [case["query"] for case in TEST_QUERIES]
+        print(f"Queries: {len(queries)}")
+        
+        # Time retrieval phases on their own; generation below repeats them.
+        # Call the model directly: rag.embed_queries goes through the on-disk cache.
+        with PhaseTimer("embedding"):
+            q_vecs = rag.embeddings.embed_documents(queries)
+        with PhaseTimer("faiss_search"):
+            rag.vectorstore.index.search(np.asarray(q_vecs, dtype=np.float32), 3)
+        
+        buckets = length_buckets(TEST_QUERIES)
+        print(f"\nGenerating suggestions in {len(buckets)} length-sorted batches...")
+        results = [None] * len(TEST_QUERIES)
+        with PhaseTimer("generate"):
+            for bucket in buckets:
+                cases = [TEST_QUERIES[i] for i in bucket]
+                bucket_results = rag.generate_suggestions_batch(
+                    queries=[case["query"] for case in cases],
+                    chat_histories=[case["chat_history"] for case in cases],
+                    scratchpads=[case["scratchpad"] for case in cases],
+                    k=3
+                )
+                for i, result in zip(bucket, bucket_results):
+                    results[i] = result
+        
+        for query, result in zip(queries, results):
+            print(f"\nQuery: {query}")
+            print("✅ Suggestion generated:")
+            print("-" * 60)
+            print(result["suggestion"])
+            print("-" * 60)
+            print(f"📚 References: {len(result['references'])} chunks retrieved")
+            for i, ref in enumerate(result["references"], 1):
+                print(f"  [{i}] Source: {ref['source']}")
+                print(f"      Preview: {ref['preview'][:100]}...")
         
         return True
     except Exception as e:
@@ -141,11 +387,9 @@ def test_rag_query():
 
 def test_api_server():
     """Test Step 4: Test API server endpoints."""
-    print("\n" + "="*60)
-    print("STEP 4: Testing API Server")
-    print("="*60)
+    print_header("STEP 4: Testing API Server")
     
-    api_url = os.getenv("RAG_API_URL", "http://localhost:5000")
+    api_url = CFG.api_url
     
     print(f"Testing API at: {api_url}")
     print("\n⚠️  Make sure the API server is running:")
@@ -154,9 +398,9 @@ def test_api_server():
     # Test health endpoint
     print(f"\n1. Testing health endpoint...")
     try:
-        response = requests.get(f"{api_url}/health", timeout=5)
+        response = SESSION.get(f"{api_url}/health", timeout=5)
         if response.status_code == 200:
-            print(f"✅ Health check passed: {response.json()}")
+            print(f"✅ Health check passed: {orjson.loads(response.content)}")
         else:
             print(f"❌ Health check failed: {response.status_code}")
             return False
@@ -169,56 +413,218 @@ def test_api_server():
         return False
     
     # Test suggest endpoint
-    print(f"\n2. Testing /api/rag/suggest endpoint...")
+    print(f"\n2. Testing /api/rag/suggest endpoint ({len(TEST_QUERIES)} concurrent requests)...")
+    
+    def post_suggest(case):
+        payload = dict(case, k=3)
+        return SESSION.post(f"{api_url}/api/rag/suggest", data=orjson.dumps(payload), timeout=30)
+    
+    try:
+        # Keep all requests in flight together so the server handles them concurrently
+        with ThreadPoolExecutor(max_workers=len(TEST_QUERIES)) as executor:
+            responses = list(executor.map(post_suggest, TEST_QUERIES))
+        
+        all_passed = True
+        for case, response in zip(TEST_QUERIES, responses):
+            print(f"\nQuery: {case['query']}")
+            if response.status_code == 200:
+                result = orjson.loads(response.content)
+                print("✅ Suggestion received:")
+                print("-" * 60)
+                print(result["suggestion"])
+                print("-" * 60)
+                print(f"📚 References: {len(result.get('references', []))} chunks")
+            else:
+                print(f"❌ Request failed: {response.status_code}")
+                print(f"   Response: {response.text}")
+                all_passed = False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+    
+    # Test streaming (SSE) variant of the suggest endpoint
+    print(f"\n3. Testing /api/rag/suggest?stream=1 endpoint...")
     try:
+        # Not one of TEST_QUERIES, which the server has just cached
         payload = {
-            "query": "How should I implement caching?",
-            "chat_history": [{"role": "user", "content": "My API is slow"}],
-            "scratchpad": "Need low latency",
+            "query": "How should I handle errors across service boundaries?",
+            "chat_history": [{"role": "user", "content": "Failures in one service cascade"}],
+            "scratchpad": "Three services talking over HTTP",
             "k": 3
         }
         
-        response = requests.post(
+        t_start = time.perf_counter()
+        t_first = None
+        tokens = []
+        references = []
+        with SESSION.post(
             f"{api_url}/api/rag/suggest",
-            json=payload,
-            headers={"Content-Type": "application/json"},
+            params={"stream": 1},
+            data=orjson.dumps(payload),
+            stream=True,
             timeout=30
-        )
+        ) as response:
+            if response.status_code != 200:
+                print(f"❌ Request failed: {response.status_code}")
+                print(f"   Response: {response.text}")
+                return False
+            
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                event = orjson.loads(data)
+                if "error" in event:
+                    print(f"❌ Stream error: {event['error']}")
+                    return False
+                if event.get("token"):
+                    if t_first is None:
+                        t_first = time.perf_counter()
+                    tokens.append(event["token"])
+                references = event.get("references", references)
+        t_last = time.perf_counter()
         
-        if response.status_code == 200:
-            result = response.json()
-            print("✅ Suggestion received:")
-            print("-" * 60)
-            print(result["suggestion"])
-            print("-" * 60)
-            print(f"\n📚 References: {len(result.get('references', []))} chunks")
-            return True
-        else:
-            print(f"❌ Request failed: {response.status_code}")
-            print(f"   Response: {response.text}")
+        if t_first is None:
+            print("❌ Stream ended without any tokens")
             return False
+        
+        print("✅ Streamed suggestion received:")
+        print("-" * 60)
+        print("".join(tokens))
+        print("-" * 60)
+        print(f"📚 References: {len(references)} chunks")
+        decode_s = t_last - t_first
+        rate = f"{(len(tokens) - 1) / decode_s:.1f}" if decode_s > 0 and len(tokens) > 1 else "n/a"
+        print(f"⏱️  TTFT: {(t_first - t_start) * 1000:.0f} ms, {len(tokens)} chunks, {rate} chunks/s")
     except Exception as e:
         print(f"❌ Error: {e}")
         return False
+    
+    return all_passed
+
+def run_service_tests(docs_future):
+    """Run steps 2 and 3 on one shared RAGService once document processing is done."""
+    # One shared service: step 2 loads the index and LLM, step 3 queries it
+    rag = None
+    try:
+        rag = rag_inference().RAGService(CFG.chunks_dir, CFG.index_dir)
+        use_embedding_cache(rag)
+        rag.load_embeddings()
+        docs_future.result()  # Sample chunks may still be being written
+        service_ok = test_rag_service(rag)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        service_ok = False
+    
+    return {
+        "RAG Service": service_ok,
+        "RAG Query": test_rag_query(rag) if service_ok else False
+    }
+
+SERVER_LOG_FILE = Path("data/.rag_api_server.log")
+# Covers loading (or building) the index and a first-time model download
+SERVER_START_TIMEOUT = 600
+LOCAL_HOSTS = ("localhost", "127.0.0.1")
+
+def ensure_api_server():
+    """Start rag_api_server.py in the background unless one is already answering /health.
+    
+    The server is left running so later runs reuse its loaded index and LLM client.
+    Only servers on this machine are started; a remote RAG_API_URL must already be up.
+    """
+    def healthy(timeout):
+        try:
+            # Plain requests (not SESSION) so the probe isn't slowed by retries
+            return requests.get(f"{CFG.api_url}/health", timeout=timeout).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+    
+    def prime():
+        # /health answers before a lazily initialized service has loaded anything;
+        # this call waits for the index, models and LLM client, so the timed
+        # concurrent requests don't all queue behind initialization
+        try:
+            response = requests.get(f"{CFG.api_url}/api/rag/cache/stats", timeout=SERVER_START_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            print(f"❌ API server did not finish initializing: {e}")
+            return False
+        if response.status_code != 200:
+            print(f"❌ API server failed to initialize: {response.status_code} {response.text}")
+            return False
+        return True
+    
+    if healthy(0.2):
+        print(f"✅ Reusing API server at {CFG.api_url}")
+        return prime()
+    
+    url = urlparse(CFG.api_url)
+    if url.hostname not in LOCAL_HOSTS:
+        print(f"❌ Cannot connect to {CFG.api_url}; only a local API server can be started automatically")
+        return False
+    
+    port = url.port or 5000
+    print(f"Starting API server on port {port} (log: {SERVER_LOG_FILE})...")
+    SERVER_LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(SERVER_LOG_FILE, 'ab') as log:
+        subprocess.Popen(
+            [sys.executable, str(Path(__file__).parent / "rag_api_server.py"), "--host", url.hostname, "--port", str(port)],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True  # Outlives this script
+        )
+    
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if healthy(1):
+            print("✅ API server is up")
+            return prime()
+        time.sleep(0.5)
+    
+    print(f"❌ API server did not become healthy within {SERVER_START_TIMEOUT}s; see {SERVER_LOG_FILE}")
+    return False
 
 def main():
     """Run all tests."""
+    parser = argparse.ArgumentParser(description="Test the RAG pipeline")
+    parser.add_argument(
+        "--server-mode",
+        action="store_true",
+        help="Test only through a persistent API server (started in the background if not running)"
+    )
+    args = parser.parse_args()
+    
     print("="*60)
     print("RAG Pipeline Test Suite")
     print("="*60)
     
+    if args.server_mode:
+        results = {"Document Processing": test_document_processing()}
+        results["API Server"] = ensure_api_server() and test_api_server()
+        print_summary(results)
+        return
+    
+    # Document processing is filesystem work, so it runs alongside the slow
+    # embedding-model load; only the index build has to wait for it
+    step_results = {}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        docs_future = executor.submit(test_document_processing)
+        futures = {
+            docs_future: "docs",
+            executor.submit(run_service_tests, docs_future): "service"
+        }
+        for future in as_completed(futures):
+            if futures[future] == "docs":
+                step_results["Document Processing"] = future.result()
+            else:
+                step_results.update(future.result())
+    
     results = {
-        "Document Processing": test_document_processing(),
-        "RAG Service": test_rag_service(),
-        "RAG Query": test_rag_query(),
+        name: step_results[name]
+        for name in ("Document Processing", "RAG Service", "RAG Query")
     }
-    
-    print("\n" + "="*60)
-    print("SUMMARY")
-    print("="*60)
-    for test_name, passed in results.items():
-        status = "✅ PASS" if passed else "❌ FAIL"
-        print(f"{status}: {test_name}")
+    print_summary(results)
     
     print("\n" + "="*60)
     print("API SERVER TEST (Manual)")
@@ -229,12 +635,31 @@ def main():
     print("  curl -X POST http://localhost:5000/api/rag/suggest \\")
     print("    -H 'Content-Type: application/json' \\")
     print("    -d '{\"query\": \"How to implement caching?\"}'")
+    print("\nOr let this script start and reuse a server:")
+    print("  python scripts/test_rag_pipeline.py --server-mode")
     
     if all(results.values()):
         print("\n✅ All core tests passed!")
     else:
         print("\n⚠️  Some tests failed. Check the errors above.")
 
+def print_summary(results):
+    """Print pass/fail per step and the recorded phase latencies."""
+    print("\n" + "="*60)
+    print("SUMMARY")
+    print("="*60)
+    for test_name, passed in results.items():
+        status = "✅ PASS" if passed else "❌ FAIL"
+        print(f"{status}: {test_name}")
+    
+    if PERF:
+        print("\nPhase latencies (ms):")
+        for phase, ms in PERF.items():
+            print(f"  {phase}: {ms:.1f}")
+        PERF_FILE.parent.mkdir(parents=True, exist_ok=True)
+        PERF_FILE.write_bytes(orjson.dumps(PERF, option=orjson.OPT_INDENT_2))
+        print(f"  (saved to {PERF_FILE})")
+
 if __name__ == "__main__":
     main()
 